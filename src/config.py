@@ -1,8 +1,23 @@
+import functools
 import os
 from typing import Dict, Any
 from dotenv import load_dotenv
 
-load_dotenv()
+from .codec import SUPPORTED_FORMATS
+
+# .env の再読み込み（ファイルI/O）はプロセスごとに一度だけで十分
+_dotenv_loaded = False
+
+
+def _load_dotenv_once() -> None:
+    """初回呼び出し時のみ .env を読み込む"""
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        load_dotenv()
+        _dotenv_loaded = True
+
+
+_load_dotenv_once()
 
 class AWSIoTConfig:
     """AWS IoT Core設定クラス"""
@@ -19,15 +34,27 @@ class AWSIoTConfig:
         self.client_id_prefix: str = os.getenv('CLIENT_ID_PREFIX', 'message-queuing-test')
         self.topic_prefix: str = os.getenv('TOPIC_PREFIX', 'test/shared')
         self.shared_subscription_group: str = os.getenv('SHARED_GROUP', 'message-queuing-group')
-        
+        self.message_format: str = os.getenv('MESSAGE_FORMAT', 'json')
+        # タイポ等で未知のフォーマットが黙ってJSONにフォールバックしないよう即座に失敗させる
+        if self.message_format not in SUPPORTED_FORMATS:
+            raise ValueError(
+                f"MESSAGE_FORMAT が不正です: {self.message_format} "
+                f"(有効値: {', '.join(SUPPORTED_FORMATS)})"
+            )
+        self.processing_delay: float = float(os.getenv('PROCESSING_DELAY', '0'))
+
+        # トピック名は毎回フォーマットせず一度だけ組み立てる
+        self.shared_topic: str = f"$share/{self.shared_subscription_group}/{self.topic_prefix}/messages"
+        self.publish_topic: str = f"{self.topic_prefix}/messages"
+
     def get_shared_topic(self) -> str:
         """シェアサブスクリプション用のトピック名を取得"""
-        return f"$share/{self.shared_subscription_group}/{self.topic_prefix}/messages"
-    
+        return self.shared_topic
+
     def get_publish_topic(self) -> str:
         """パブリッシュ用のトピック名を取得"""
-        return f"{self.topic_prefix}/messages"
-    
+        return self.publish_topic
+
     def validate(self) -> bool:
         """設定の妥当性を確認"""
         required_files = [self.root_ca_path, self.cert_path, self.private_key_path]
@@ -35,4 +62,10 @@ class AWSIoTConfig:
             if not os.path.exists(file_path):
                 print(f"証明書ファイルが見つかりません: {file_path}")
                 return False
-        return True
\ No newline at end of file
+        return True
+
+
+@functools.lru_cache(maxsize=1)
+def get_config() -> AWSIoTConfig:
+    """共有のAWSIoTConfigインスタンスを取得（初回のみ構築）"""
+    return AWSIoTConfig()
\ No newline at end of file
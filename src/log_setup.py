@@ -0,0 +1,40 @@
+"""
+バッファリングされたロギング設定
+
+ホットパスでの print() は stdout のロック取得と同期 write() を伴い、
+高レートではMQTT処理そのものよりコストが大きくなる。
+QueueHandler → QueueListener 構成でログ出力をバックグラウンド
+スレッドに逃がし、送受信スレッドがI/Oでブロックしないようにする。
+ログレベルは LOG_LEVEL 環境変数で変更できる（デフォルト: INFO）
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+from queue import SimpleQueue
+from typing import Optional
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: Optional[int] = None) -> None:
+    """キュー経由の非同期ロギングをセットアップ（初回のみ有効）"""
+    global _listener
+    if _listener is not None:
+        return
+
+    if level is None:
+        level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+
+    log_queue: "SimpleQueue[logging.LogRecord]" = SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -4,16 +4,19 @@ AWS IoT Core Message Queuing テスト用パブリッシャー
 QoS1メッセージを定期的に送信し、シェアサブスクライバーの応答を監視
 """
 
-import json
+import asyncio
+import logging
+import os
 import time
-import uuid
-import threading
-from datetime import datetime
-from typing import Optional
+from typing import Any, Dict, List, Optional
 from awsiot import mqtt_connection_builder
 from awscrt import mqtt, http
 from concurrent.futures import Future
-from .config import AWSIoTConfig
+from .codec import encode_message
+from .config import AWSIoTConfig, get_config
+from .log_setup import setup_logging
+
+log = logging.getLogger(__name__)
 
 
 class IoTMessagePublisher:
@@ -23,7 +26,21 @@ class IoTMessagePublisher:
         self.mqtt_connection: Optional[mqtt.Connection] = None
         self.is_connected = False
         self.publish_count = 0
-        self.lock = threading.Lock()
+        self.sequence = 0
+        # 固定フィールドは毎回の dict 構築を避けるため一度だけ用意する
+        # （MappingProxyTypeはorjson/msgspecで直接シリアライズできないためplain dictのまま
+        # 全メッセージで共有する。送信側で変更しないこと）
+        self._data_payload: Dict[str, Any] = {
+            "temperature": 25.5, "humidity": 60.0, "status": "normal"
+        }
+        # メッセージ全体のテンプレート。可変の3キーのみ送信ごとに上書きする
+        self._message_template: Dict[str, Any] = {
+            "message_id": "",
+            "timestamp": 0,
+            "sender": self.client_id,
+            "data": self._data_payload,
+            "sequence": 0,
+        }
 
     def setup_mqtt_connection(self) -> mqtt.Connection:
         """AWS IoT SDK MQTT接続のセットアップ"""
@@ -54,11 +71,12 @@ class IoTMessagePublisher:
         """パブリッシュ完了時のコールバック"""
         try:
             publish_future.result()  # Exception が発生した場合はここで例外が発生
-            with self.lock:
-                self.publish_count += 1
-                print(f"[Publisher] メッセージ送信完了 (総数: {self.publish_count})")
+            # 単純なインクリメントはGILによりアトミックなためロック不要
+            self.publish_count += 1
+            # %フォーマットはDEBUG無効時にはスキップされる（遅延評価）
+            log.debug("[Publisher] メッセージ送信完了 (総数: %d)", self.publish_count)
         except Exception as e:
-            print(f"[Publisher] メッセージ送信失敗: {e}")
+            log.error("[Publisher] メッセージ送信失敗: %s", e)
 
     def connect(self) -> bool:
         """AWS IoT Coreに接続"""
@@ -80,57 +98,120 @@ class IoTMessagePublisher:
             self.is_connected = False
             return False
 
+    def build_test_message(self, message_id: Optional[str] = None) -> Dict[str, Any]:
+        """テストメッセージを構築（シーケンス番号を採番）"""
+        if message_id is None:
+            # uuid.uuid4() の UUID オブジェクト構築を省き、同じ128bitエントロピーの
+            # hex文字列を直接生成する
+            message_id = os.urandom(16).hex()
+
+        self.sequence += 1
+        # バッチ内の各メッセージが同一dictを共有しないようテンプレートをコピーし、
+        # 可変キーのみ上書きする（固定キーの再構築・再ハッシュを省く）
+        message = self._message_template.copy()
+        message["message_id"] = message_id
+        # datetimeオブジェクト構築とISO文字列化を省き、int64ナノ秒で持つ
+        message["timestamp"] = time.time_ns()
+        message["sequence"] = self.sequence
+        return message
+
     def publish_test_message(self, message_id: Optional[str] = None) -> bool:
         """テストメッセージを送信"""
         if not self.is_connected or not self.mqtt_connection:
             print("[Publisher] 未接続のためメッセージ送信をスキップ")
             return False
 
-        if message_id is None:
-            message_id = str(uuid.uuid4())
-
-        message = {
-            "message_id": message_id,
-            "timestamp": datetime.now().isoformat(),
-            "sender": self.client_id,
-            "data": {"temperature": 25.5, "humidity": 60.0, "status": "normal"},
-            "sequence": self.publish_count + 1,
-        }
+        message = self.build_test_message(message_id)
+        message_id = message["message_id"]
 
         try:
             topic = self.config.get_publish_topic()
             publish_future, packet_id = self.mqtt_connection.publish(
                 topic=topic,
-                payload=json.dumps(message),
+                payload=encode_message(message, self.config.message_format),
                 qos=mqtt.QoS.AT_LEAST_ONCE
             )
             
             # 非同期でパブリッシュ完了を待機
             publish_future.add_done_callback(self._on_publish_complete)
-            
-            print(f"[Publisher] メッセージ送信: {message_id} (Packet ID: {packet_id})")
+
+            log.debug("[Publisher] メッセージ送信: %s (Packet ID: %s)", message_id, packet_id)
             return True
             
         except Exception as e:
             print(f"[Publisher] 送信エラー: {e}")
             return False
 
-    def start_continuous_publishing(
-        self, interval: float = 2.0, max_messages: int = 50
+    async def publish_batch(self, messages: List[Dict[str, Any]]) -> int:
+        """複数メッセージをまとめて送信し、バッチ単位で完了を待機
+
+        1件ずつ publish → 完了待ち を繰り返すのではなく、ペイロードを
+        先にシリアライズしてから publish を連続投入し、最後に一括で
+        完了を待つことで送信オーバーヘッドを償却する。
+        戻り値は送信に成功したメッセージ数
+        """
+        if not self.is_connected or not self.mqtt_connection:
+            print("[Publisher] 未接続のためバッチ送信をスキップ")
+            return 0
+
+        topic = self.config.get_publish_topic()
+        message_format = self.config.message_format
+        payloads = [encode_message(message, message_format) for message in messages]
+
+        futures = []
+        try:
+            for payload in payloads:
+                publish_future, packet_id = self.mqtt_connection.publish(
+                    topic=topic,
+                    payload=payload,
+                    qos=mqtt.QoS.AT_LEAST_ONCE
+                )
+                publish_future.add_done_callback(self._on_publish_complete)
+                futures.append(publish_future)
+        except Exception as e:
+            print(f"[Publisher] バッチ送信エラー: {e}")
+
+        if not futures:
+            return 0
+
+        # CRTのFutureをasyncioに橋渡しし、バッチ全体の完了を一度だけ待機
+        results = await asyncio.gather(
+            *(asyncio.wrap_future(f) for f in futures), return_exceptions=True
+        )
+        return sum(1 for result in results if not isinstance(result, BaseException))
+
+    async def start_continuous_publishing(
+        self, interval: float = 2.0, max_messages: int = 50, batch_size: int = 16
     ):
-        """連続的にメッセージを送信"""
-        print(f"[Publisher] 連続送信開始 (間隔: {interval}秒, 最大: {max_messages}件)")
+        """連続的にメッセージを送信（intervalごとにバッチ単位で送信）"""
+        print(
+            f"[Publisher] 連続送信開始 (間隔: {interval}秒, 最大: {max_messages}件, "
+            f"バッチサイズ: {batch_size}件)"
+        )
 
-        for i in range(max_messages):
+        # 失敗時にループが止まらないよう送信回数は試行ベースで数え、
+        # 進捗表示には成功数を使う
+        attempted = 0
+        succeeded = 0
+        # 送信レイテンシが周期に累積しないよう単調時刻のデッドラインで刻む
+        deadline = time.monotonic()
+        while attempted < max_messages:
             if not self.is_connected:
                 print("[Publisher] 接続が切断されたため送信を停止")
                 break
 
-            success = self.publish_test_message()
-            if success:
-                print(f"[Publisher] 進捗: {i+1}/{max_messages}")
+            batch = [
+                self.build_test_message()
+                for _ in range(min(batch_size, max_messages - attempted))
+            ]
+            attempted += len(batch)
+            succeeded += await self.publish_batch(batch)
+            print(f"[Publisher] 進捗: 成功 {succeeded}/{max_messages} (試行: {attempted})")
 
-            time.sleep(interval)
+            deadline += interval
+            sleep_for = deadline - time.monotonic()
+            if sleep_for > 0:
+                await asyncio.sleep(sleep_for)
 
         print("[Publisher] 連続送信完了")
         print(f"📊 送信サマリー: {self.publish_count}件のメッセージを送信しました")
@@ -155,9 +236,10 @@ class IoTMessagePublisher:
             print("[Publisher] 既に切断状態です")
 
 
-def main():
-    """メイン実行関数"""
-    config = AWSIoTConfig()
+async def main():
+    """メイン実行関数（単一のイベントループ上で実行）"""
+    setup_logging()
+    config = get_config()
 
     if not config.validate():
         print("設定の検証に失敗しました")
@@ -173,16 +255,19 @@ def main():
 
         # テストメッセージの送信
         print("\n=== メッセージキューイングテスト開始 ===")
-        publisher.start_continuous_publishing(interval=1.0, max_messages=20)
+        await publisher.start_continuous_publishing(interval=1.0, max_messages=20)
 
         # 少し待機
-        time.sleep(5)
+        await asyncio.sleep(5)
 
-    except KeyboardInterrupt:
+    except asyncio.CancelledError:
         print("\n[Publisher] 中断されました")
     finally:
         publisher.disconnect()
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -4,35 +4,114 @@ AWS IoT Core Message Queuing テスト用シェアサブスクライバー
 シェアサブスクリプションでメッセージを受信し、接続断絶をシミュレート
 """
 
-import json
+import asyncio
+import logging
 import time
 import threading
 import random
-import signal
-import sys
-from datetime import datetime
-from typing import Optional, Dict, Any
+from collections import deque
+from multiprocessing import shared_memory
+from queue import SimpleQueue
+from typing import Callable, Deque, Optional, Dict, Any, Tuple
+
+import numpy as np
 from awsiot import mqtt_connection_builder
-from awscrt import mqtt
-from concurrent.futures import Future
-from .config import AWSIoTConfig
+from awscrt import io, mqtt
+from concurrent.futures import Future, ThreadPoolExecutor
+from .codec import decode_message
+from .config import AWSIoTConfig, get_config
+from .log_setup import setup_logging
+
+log = logging.getLogger(__name__)
+
+# 共有カウンターの配置間隔（uint64換算）。各スロットを128バイト境界に置き、
+# 隣接サブスクライバーのインクリメントが同一キャッシュラインを奪い合う
+# 偽共有を避ける。128バイトはApple silicon等の大きいラインサイズも覆う
+COUNTER_STRIDE = 16
+
+
+def build_shared_mqtt_client(config: AWSIoTConfig) -> mqtt.Client:
+    """TLSコンテキストとイベントループを共有するMQTTクライアントを構築
+
+    サブスクライバーごとに TLS コンテキスト・イベントループ・ブート
+    ストラップを作ると証明書のパースやスレッドが N 個分重複するため、
+    一度だけ構築して全接続で共有する（クライアントIDと
+    ソケット・セッションは接続ごとに独立のまま）
+    """
+    event_loop_group = io.EventLoopGroup(1)
+    host_resolver = io.DefaultHostResolver(event_loop_group)
+    bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+
+    tls_options = io.TlsContextOptions.create_client_with_mtls_from_path(
+        config.cert_path, config.private_key_path
+    )
+    tls_options.override_default_trust_store_from_path(None, config.root_ca_path)
+    tls_context = io.ClientTlsContext(tls_options)
+
+    return mqtt.Client(bootstrap, tls_context)
 
 
 class IoTSharedSubscriber:
-    def __init__(self, config: AWSIoTConfig, subscriber_id: str):
+    def __init__(
+        self,
+        config: AWSIoTConfig,
+        subscriber_id: str,
+        mqtt_client: Optional[mqtt.Client] = None,
+        counters: Optional[np.ndarray] = None,
+        counter_index: int = 0,
+    ):
         self.config = config
         self.subscriber_id = subscriber_id
         self.client_id = f"{config.client_id_prefix}-subscriber-{subscriber_id}"
+        # ログ用プレフィックスは毎回フォーマットせず一度だけ組み立てる
+        self._log_prefix = f"[Subscriber-{subscriber_id}]"
+        self._mqtt_client = mqtt_client
         self.mqtt_connection: Optional[mqtt.Connection] = None
         self.is_connected = False
-        self.message_count = 0
-        self.processed_messages: Dict[str, Any] = {}
-        self.lock = threading.Lock()
+        # マネージャー配下では共有メモリ上のカウンタースロットを使用し、
+        # 統計側がロックなしで集計できるようにする
+        self._counters = counters
+        self._counter_index = counter_index
+        self._message_count = 0  # 単体利用時のフォールバック
+        # 長時間稼働でもメモリが際限なく増えないよう直近分のみ保持するリングバッファ
+        self.recent_messages: Deque[Tuple[str, int]] = deque(maxlen=10_000)
         self.should_disconnect = False
         self.disconnect_duration = 0
+        # CRTコールバックをブロックしないよう処理は専用ワーカースレッドへ委譲
+        # （Noneは停止シグナル）
+        self._work_queue: "SimpleQueue[Optional[Tuple[str, bytes]]]" = SimpleQueue()
+        self._worker = threading.Thread(target=self._process_messages, daemon=True)
+        self._worker.start()
+
+    @property
+    def message_count(self) -> int:
+        """累計受信メッセージ数"""
+        if self._counters is not None:
+            return int(self._counters[self._counter_index])
+        return self._message_count
+
+    def _increment_message_count(self) -> None:
+        """受信カウンターをインクリメント（共有スロットまたはローカル）"""
+        if self._counters is not None:
+            self._counters[self._counter_index] += 1
+        else:
+            self._message_count += 1
 
     def setup_mqtt_connection(self) -> mqtt.Connection:
         """AWS IoT SDK MQTT接続のセットアップ"""
+        if self._mqtt_client is not None:
+            # 共有クライアント経由ではTLSコンテキストを再構築しない
+            return mqtt.Connection(
+                client=self._mqtt_client,
+                host_name=self.config.endpoint,
+                port=8883,
+                client_id=self.client_id,
+                clean_session=False,  # 永続セッションを有効化
+                keep_alive_secs=30,
+                on_connection_interrupted=self._on_connection_interrupted,
+                on_connection_resumed=self._on_connection_resumed
+            )
+
         return mqtt_connection_builder.mtls_from_path(
             endpoint=self.config.endpoint,
             cert_filepath=self.config.cert_path,
@@ -61,38 +140,61 @@ class IoTSharedSubscriber:
             print(f"[Subscriber-{self.subscriber_id}] 🔄 キューイングされたメッセージを受信開始")
 
     def _on_message_received(self, topic, payload, dup, qos, retain, **kwargs):
-        """メッセージ受信時のコールバック"""
-        try:
-            message_data = json.loads(payload.decode())
-            message_id = message_data.get("message_id", "unknown")
-
-            with self.lock:
-                self.message_count += 1
-                qos_value = qos.value if hasattr(qos, 'value') else qos
-                self.processed_messages[message_id] = {
-                    "received_at": datetime.now().isoformat(),
-                    "topic": topic,
-                    "qos": qos_value,
-                    "data": message_data,
-                }
-
-            print(
-                f"[Subscriber-{self.subscriber_id}] メッセージ受信 #{self.message_count}: {message_id}"
-            )
-            print(f"  - 送信者: {message_data.get('sender', 'unknown')}")
-            print(f"  - シーケンス: {message_data.get('sequence', 'unknown')}")
-            print(f"  - データ: {message_data.get('data', {})}")
+        """メッセージ受信時のコールバック（ワーカーへ引き渡してすぐ返る）
 
-            # メッセージ処理のシミュレーション（少し時間をかける）
-            time.sleep(0.1)
+        CRTコールバックスレッド内で重い処理をするとメッセージ配信全体が
+        直列化されるため、デコード以降はワーカースレッドで行う
+        """
+        self._work_queue.put((topic, payload))
 
-        except Exception as e:
-            print(f"[Subscriber-{self.subscriber_id}] メッセージ処理エラー: {e}")
+    def _process_messages(self) -> None:
+        """受信メッセージをワーカースレッドで処理"""
+        while True:
+            item = self._work_queue.get()
+            if item is None:  # 停止シグナル
+                break
+            topic, payload = item
+            try:
+                message = decode_message(payload, self.config.message_format)
+                message_id = message.message_id
+
+                # カウンター更新はスロットごとに書き手がこのワーカー1本だけなので
+                # 安全（numpy要素のRMWはGILアトミックではない）。deque.appendはGILアトミック
+                self._increment_message_count()
+                # 受信時刻はint64ナノ秒で保持（文字列化はログ時のみ）
+                self.recent_messages.append((message_id, time.time_ns()))
+
+                # DEBUG無効時は引数の取り出しごとスキップする
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(
+                        "%s メッセージ受信 #%d: %s (送信者: %s, シーケンス: %s, データ: %s)",
+                        self._log_prefix,
+                        self.message_count,
+                        message_id,
+                        message.sender,
+                        message.sequence,
+                        message.data,
+                    )
+
+                # メッセージ処理のシミュレーション（必要な場合のみ有効化）
+                if self.config.processing_delay > 0:
+                    time.sleep(self.config.processing_delay)
+
+            except Exception as e:
+                log.error("%s メッセージ処理エラー: %s", self._log_prefix, e)
+
+    def stop_worker(self) -> None:
+        """ワーカースレッドを停止（キューの残りを処理してから終了）"""
+        self._work_queue.put(None)
+        self._worker.join(timeout=5)
 
     def connect(self) -> bool:
         """AWS IoT Coreに接続"""
         try:
-            self.mqtt_connection = self.setup_mqtt_connection()
+            # 再接続時は既存の接続オブジェクトを再利用し、
+            # TLS設定や証明書の再読み込みを避ける
+            if self.mqtt_connection is None:
+                self.mqtt_connection = self.setup_mqtt_connection()
             print(f"[Subscriber-{self.subscriber_id}] {self.config.endpoint} に接続中...")
             
             connect_future = self.mqtt_connection.connect()
@@ -120,8 +222,16 @@ class IoTSharedSubscriber:
             self.is_connected = False
             return False
 
-    def simulate_disconnect(self, duration: int = 10):
-        """接続断絶をシミュレート"""
+    def simulate_disconnect(
+        self,
+        duration: int = 10,
+        schedule_reconnect: Optional[Callable[[float, Callable[[], None]], None]] = None,
+    ):
+        """接続断絶をシミュレート
+
+        再接続はマネージャーの共有スケジューラーに登録する。
+        単体利用時のみ threading.Timer にフォールバック
+        """
         if not self.is_connected:
             return
 
@@ -145,25 +255,34 @@ class IoTSharedSubscriber:
                 self.is_connected = False
 
         # 指定時間後に再接続
-        def reconnect_after_delay():
-            time.sleep(duration)
-            if self.should_disconnect:
-                print(f"[Subscriber-{self.subscriber_id}] 再接続試行中...")
-                self.should_disconnect = False
-                self.connect()
-
-        threading.Thread(target=reconnect_after_delay, daemon=True).start()
+        if schedule_reconnect is not None:
+            schedule_reconnect(duration, self._reconnect)
+        else:
+            timer = threading.Timer(duration, self._reconnect)
+            timer.daemon = True
+            timer.start()
+
+    def _reconnect(self) -> None:
+        """シミュレーション切断後の再接続"""
+        if self.should_disconnect:
+            print(f"[Subscriber-{self.subscriber_id}] 再接続試行中...")
+            self.should_disconnect = False
+            self.connect()
 
     def get_stats(self) -> Dict[str, Any]:
-        """統計情報を取得"""
-        with self.lock:
-            return {
-                "subscriber_id": self.subscriber_id,
-                "client_id": self.client_id,
-                "is_connected": self.is_connected,
-                "message_count": self.message_count,
-                "processed_message_ids": list(self.processed_messages.keys()),
-            }
+        """統計情報を取得
+
+        書き手はワーカースレッド1本のみのため、ロックなしの
+        ベストエフォートなスナップショットを返す
+        """
+        recent_ids = [message_id for message_id, _ in list(self.recent_messages)[-10:]]
+        return {
+            "subscriber_id": self.subscriber_id,
+            "client_id": self.client_id,
+            "is_connected": self.is_connected,
+            "message_count": self.message_count,
+            "recent_message_ids": recent_ids,
+        }
 
     def disconnect(self):
         """接続を切断"""
@@ -191,21 +310,61 @@ class MultiSubscriberManager:
         self.config = config
         self.subscribers = []
         self.running = True
+        self._prev_total = 0  # 前回統計表示時の合計受信数（差分表示用）
+        # simulate_random_disconnects開始時に実行中のイベントループを保持
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # TLSコンテキスト等は全サブスクライバーで共有
+        self._mqtt_client = build_shared_mqtt_client(config)
+
+        # 受信カウンターは共有メモリ上のuint64配列に置き、
+        # 統計側はサブスクライバーのロックに触れず一括で読み取る。
+        # スロットはCOUNTER_STRIDE刻みで配置してキャッシュラインを分離する
+        self._counter_shm = shared_memory.SharedMemory(
+            create=True, size=8 * COUNTER_STRIDE * num_subscribers
+        )
+        counter_slots: np.ndarray = np.ndarray(
+            (num_subscribers * COUNTER_STRIDE,),
+            dtype=np.uint64,
+            buffer=self._counter_shm.buf,
+        )
+        counter_slots[:] = 0
+        # 実カウンターは各キャッシュラインの先頭要素を指すストライドビュー
+        self._counters: np.ndarray = counter_slots[::COUNTER_STRIDE]
 
         # 複数のサブスクライバーを作成
         for i in range(num_subscribers):
-            subscriber = IoTSharedSubscriber(config, f"{i+1:02d}")
+            subscriber = IoTSharedSubscriber(
+                config,
+                f"{i+1:02d}",
+                mqtt_client=self._mqtt_client,
+                counters=self._counters,
+                counter_index=i,
+            )
             self.subscribers.append(subscriber)
 
+    def schedule_reconnect(self, delay: float, action: Callable[[], None]) -> None:
+        """指定秒数後に再接続アクションを実行するよう登録
+
+        connect() はブロッキングするためイベントループを塞がないよう
+        executorで実行する。呼び出し元もexecutorスレッドのため、
+        登録はcall_soon_threadsafe経由で行う
+        """
+        loop = self._loop
+        if loop is None:
+            raise RuntimeError("切断シミュレーション開始前に再接続は登録できません")
+        loop.call_soon_threadsafe(
+            loop.call_later, delay, lambda: loop.run_in_executor(None, action)
+        )
+
     def start_all(self) -> bool:
         """全サブスクライバーを開始"""
         print(f"[Manager] {len(self.subscribers)}個のサブスクライバーを開始...")
 
-        success_count = 0
-        for subscriber in self.subscribers:
-            if subscriber.connect():
-                success_count += 1
-                time.sleep(1)  # 接続間隔を空ける
+        # TLSハンドシェイクはI/Oバウンドなため直列ではなく並列に実行する
+        with ThreadPoolExecutor(max_workers=len(self.subscribers)) as executor:
+            results = list(executor.map(lambda s: s.connect(), self.subscribers))
+        success_count = sum(1 for connected in results if connected)
 
         print(
             f"[Manager] {success_count}/{len(self.subscribers)} 個のサブスクライバーが接続成功"
@@ -218,12 +377,13 @@ class MultiSubscriberManager:
         
         return success_count > 0
 
-    def simulate_random_disconnects(self):
-        """ランダムに接続断絶をシミュレート"""
+    async def simulate_random_disconnects(self):
+        """ランダムに接続断絶をシミュレート（イベントループ上のタスク）"""
         print("[Manager] ランダム接続断絶シミュレーション開始")
+        self._loop = asyncio.get_running_loop()
 
         while self.running:
-            time.sleep(random.uniform(5, 15))  # 5-15秒間隔
+            await asyncio.sleep(random.uniform(5, 15))  # 5-15秒間隔
 
             if not self.running:
                 break
@@ -233,27 +393,36 @@ class MultiSubscriberManager:
             if connected_subscribers:
                 target = random.choice(connected_subscribers)
                 duration = random.randint(8, 20)  # 8-20秒間切断
-                target.simulate_disconnect(duration)
-
-    def print_stats(self):
-        """統計情報を表示"""
+                # simulate_disconnectはdisconnect完了を最大10秒待つため、
+                # イベントループを塞がないようexecutorで実行する
+                await self._loop.run_in_executor(
+                    None,
+                    lambda: target.simulate_disconnect(
+                        duration, schedule_reconnect=self.schedule_reconnect
+                    ),
+                )
+
+    def print_stats(self, interval: float = 10.0):
+        """統計情報を表示（前回表示からの差分ベース）"""
         print("\n=== サブスクライバー統計 ===")
-        total_messages = 0
-        disconnected_count = 0
-        for subscriber in self.subscribers:
-            stats = subscriber.get_stats()
-            status = "接続中" if stats["is_connected"] else "切断中"
-            message_count = stats['message_count']
-            total_messages += message_count
-            if not stats["is_connected"]:
-                disconnected_count += 1
-            print(
-                f"  {stats['subscriber_id']}: {status}, メッセージ数: {message_count}"
-            )
-        
-        print(f"📊 合計受信メッセージ数: {total_messages}")
-        
+        # 合計は共有メモリ配列の一括集計で取得（ロック・Pythonループ不要）
+        total_messages = int(self._counters.sum())
+        delta = total_messages - self._prev_total
+        self._prev_total = total_messages
+
+        disconnected_count = sum(1 for s in self.subscribers if not s.is_connected)
+        print(
+            f"📊 合計受信メッセージ数: {total_messages} "
+            f"(直近 +{delta}, {delta / interval:.1f} msg/s)"
+        )
+
         if disconnected_count > 0:
+            # 切断中のサブスクライバーがいる場合のみ個別の内訳を表示
+            for subscriber in self.subscribers:
+                status = "接続中" if subscriber.is_connected else "切断中"
+                print(
+                    f"  {subscriber.subscriber_id}: {status}, メッセージ数: {subscriber.message_count}"
+                )
             print(f"⏳ {disconnected_count}個のサブスクライバーが切断中")
             print("💡 切断中のサブスクライバー再接続時にキューイングメッセージが配信されます")
             print("🔄 Message Queuing機能 動作中！")
@@ -265,56 +434,62 @@ class MultiSubscriberManager:
         self.running = False
         print("[Manager] 全サブスクライバーを停止中...")
 
-        for subscriber in self.subscribers:
-            subscriber.disconnect()
+        # 切断も並列に実行する
+        with ThreadPoolExecutor(max_workers=len(self.subscribers)) as executor:
+            list(executor.map(lambda s: s.disconnect(), self.subscribers))
 
+        # 共有メモリの解放前にワーカーを停止させる。停止後でないと、
+        # ワーカーが解放済みバッファへ書き込む競合が起こり得る
+        for subscriber in self.subscribers:
+            subscriber.stop_worker()
 
-def signal_handler(sig, frame):
-    """シグナルハンドラー"""
-    print("\n[Main] 中断シグナル受信")
-    sys.exit(0)
+        # カウンターをローカルへ退避してからビューを外し、セグメントを解放
+        for subscriber in self.subscribers:
+            subscriber._message_count = subscriber.message_count
+            subscriber._counters = None
+        self._counters = None
+        self._counter_shm.close()
+        self._counter_shm.unlink()
 
 
-def main():
-    """メイン実行関数"""
-    config = AWSIoTConfig()
+async def main():
+    """メイン実行関数（単一のイベントループ上で実行）"""
+    setup_logging()
+    config = get_config()
 
     if not config.validate():
         print("設定の検証に失敗しました")
         return
 
-    # シグナルハンドラー設定
-    signal.signal(signal.SIGINT, signal_handler)
-    
     manager = MultiSubscriberManager(config, num_subscribers=3)
 
     try:
         print("[Main] サブスクライバー開始中...")
-        
+
         # 全サブスクライバーを開始
         if not manager.start_all():
             print("サブスクライバーの開始に失敗しました")
             return
 
-        # ランダム切断シミュレーションを開始
-        disconnect_thread = threading.Thread(
-            target=manager.simulate_random_disconnects, daemon=True
-        )
-        disconnect_thread.start()
+        # ランダム切断シミュレーションをタスクとして開始
+        disconnect_task = asyncio.create_task(manager.simulate_random_disconnects())
 
         print("\n=== メッセージキューイングテスト実行中 ===")
         print("Ctrl+C で終了")
 
         # 定期的に統計を表示（無限ループ）
         while True:
-            time.sleep(10)
+            await asyncio.sleep(10)
             manager.print_stats()
 
-    except KeyboardInterrupt:
+    except asyncio.CancelledError:
         print("\n[Main] 中断されました")
     finally:
         manager.stop_all()
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass